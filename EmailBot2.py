@@ -4,17 +4,22 @@ import time
 import json
 import base64
 import uuid
+import hashlib
 import logging
 import requests
 import msal
-import html2text
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import html
 import re
+import bisect
 import google.generativeai as genai
 import numpy as np
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
 # --- Step 0: Load Environment Variables ---
 load_dotenv()
@@ -35,13 +40,106 @@ SHEET_OPPORTUNITIES = "OpportunitiesMaster"
 SHEET_INTERACTIONS = "InteractionLog"
 TOKEN_CACHE_FILE = "msal_token_cache.bin"
 TIMESTAMP_FILE = "last_run_timestamp.txt" 
-PROCESSED_EMAILS_FILE = "processed_emails.json"  # Track processed emails to prevent duplicates
+PROCESSED_EMAILS_FILE = "processed_emails.log"  # Track processed emails to prevent duplicates (one ID and received time per line)
+LEGACY_PROCESSED_EMAILS_FILE = "processed_emails.json"  # Older JSON format, migrated on first load
+RECENT_HOURS_BACK = 48  # Listing window for new mail; twice the daily schedule so emails a run left unprocessed are seen again
+PROCESSED_EMAILS_RETENTION_DAYS = 7  # Processed IDs older than this can't be in the listing window again
+PROCESSED_EMAILS_COMPACT_LINES = 10000  # Rewrite the processed log without expired IDs once it grows past this
+OPPORTUNITIES_CACHE_FILE = "opportunities_cache.json"  # Last read of OpportunitiesMaster, keyed by the workbook eTag
+EXTRACTION_CACHE_FILE = "extraction_cache.json"  # Gemini extraction results for emails not yet processed, so a rerun doesn't pay for them again
+CONTENT_HASHES_FILE = "content_hashes.json"  # Opportunity each distinct email content was filed under, for duplicate mail
+CONTENT_HASH_DAYS = 30  # Content hashes older than this are dropped
+CONTENT_HASH_MIN_PREVIEW = 40  # Shorter previews are too generic to treat identical ones as the same email
+CONVERSATION_MAP_FILE = "conversation_map.json"  # Opportunity each conversation was filed under, including threads the workbook doesn't record
+HISTORICAL_EMAILS_CACHE_FILE = "historical_emails_cache.json"  # Historical emails from earlier runs, so each run only fetches the new ones
+HISTORICAL_REFETCH_MINUTES = 60  # Re-read this far behind the cached cursor in case mail was indexed late
+REPLY_PREFIX_RE = re.compile(r'^(\s*(re|fw|fwd)\s*:)+', re.IGNORECASE)
+COMPANY_PUNCTUATION_RE = re.compile(r"[^\w\s&]|_")  # "Acme, Inc." and "Acme Inc" index to the same name
+HTML_TAG_RE = re.compile(r"<(script|style)[^>]*>.*?</\1>|<[^>]+>", re.S | re.I)  # Tags, plus script/style blocks whole
+WHITESPACE_RE = re.compile(r"\s+")
+HISTORICAL_PAGE_SIZE = 1000  # Messages per historical page request (the most Graph returns per page)
+HISTORICAL_FETCH_WORKERS = 4  # Historical pages fetched in parallel
+RECENT_PAGE_SIZE = 100  # Messages per page for the 24h listing (Graph defaults to 10)
+EXCEL_ROWS_PER_REQUEST = 500  # Rows sent in a single rows/add call
+BODY_CHAR_CAP = 16384  # Body characters kept per email (Gemini sees the first 2000, rows the first 500)
+GRAPH_BATCH_URL = "https://graph.microsoft.com/v1.0/$batch"
+GRAPH_BATCH_LIMIT = 20  # Maximum number of sub-requests Graph accepts in one $batch call
 SCOPES = ["User.Read", "Mail.Read", "Files.ReadWrite.All"] # You will have to allow these in microsoft AZURE. If you dont do that then it will not work as it needs it to read your mail and extract the data from it.
 
+OPPORTUNITY_EXTRACTION_INSTRUCTIONS = """
+You are a CRM assistant. Given the email below, extract all distinct sales opportunities. For each opportunity, return: title, summary, action_item, contact_name, contact_company, and contact_email. If no opportunities are found, return an empty list: []
+
+A sales opportunity is defined as:
+- A potential business deal or project
+- Request for proposal/quote
+- Product inquiry with commercial intent
+- Service request that could lead to revenue
+- Partnership discussion with business potential
+
+Exclude:
+- General inquiries without clear commercial intent
+- Support requests
+- Administrative communications
+- Social/networking emails
+
+Respond ONLY in valid JSON format: [{...}]
+"""
+OPPORTUNITY_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            field: {"type": "STRING"}
+            for field in ["title", "summary", "action_item", "contact_name", "contact_company", "contact_email"]
+        },
+        "required": ["title", "summary"]
+    }
+}
+OPPORTUNITY_BATCH_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {"email_index": {"type": "INTEGER"}, "opportunities": OPPORTUNITY_SCHEMA},
+        "required": ["email_index", "opportunities"]
+    }
+}
+GEMINI_BATCH_SIZE = 10  # Emails sent to Gemini in one extraction request
+EXTRACTION_WORKERS = 4  # Extraction batches (body fetches + Gemini call) run in parallel
+# Emails mentioning none of these are treated as having no opportunities without asking Gemini.
+# Add words here if real leads are being skipped.
+OPPORTUNITY_KEYWORDS = [
+    r"quote", r"quotation", r"rfp", r"rfq", r"rfi", r"proposal", r"pricing", r"price", r"cost",
+    r"demo", r"partner(ship)?", r"contract", r"budget", r"invoice", r"project", r"services?",
+    r"inquir\w*", r"enquir\w*", r"interest(ed)?", r"onboard\w*", r"purchase", r"order", r"deal"
+]
+OPPORTUNITY_SIGNAL_RE = re.compile(r"\b(" + "|".join(OPPORTUNITY_KEYWORDS) + r")\b", re.IGNORECASE)
+
 # === 3. Helper Functions ===
-html_converter = html2text.HTML2Text()
-html_converter.ignore_links = True
-html_converter.body_width = 0
+# One pooled session for every Graph call so connections (and their TLS handshakes) are reused.
+# Only idempotent requests are retried; POSTs such as row inserts are never replayed.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+))
+
+# Gemini is configured once per process and every call shares one model. The instructions go in
+# as the system instruction so each request has the same prompt prefix and only the email changes.
+if GEMINI_API_KEY:
+    genai.configure(api_key=GEMINI_API_KEY)
+GEMINI_MODEL = genai.GenerativeModel(
+    'gemini-2.5-flash',
+    system_instruction=OPPORTUNITY_EXTRACTION_INSTRUCTIONS,
+    # Structured output: Gemini returns bare JSON matching the schema, no code fences to strip.
+    # Temperature 0 keeps extraction deterministic, so a cached result is as good as a fresh call.
+    generation_config={"temperature": 0, "response_mime_type": "application/json", "response_schema": OPPORTUNITY_SCHEMA}
+)
+
+def html_to_text(body_html):
+    """Strips tags from an email's HTML body, leaving plain text for Gemini."""
+    text = html.unescape(HTML_TAG_RE.sub(" ", body_html))
+    return WHITESPACE_RE.sub(" ", text).strip()
 
 def get_access_token(client_id, tenant_id):
     """Handles MSAL authentication and token acquisition."""
@@ -65,129 +163,444 @@ def get_access_token(client_id, tenant_id):
     logging.info("Access token acquired.")
     return {"Authorization": f"Bearer {token_response['access_token']}"}
 
-def get_excel_file_id(share_link, headers):
-    """Converts a SharePoint share link to a drive item ID."""
+def get_excel_file_item(share_link, headers):
+    """Resolves a SharePoint share link to its drive item (id and eTag)."""
     encoded_bytes = base64.b64encode(share_link.encode('utf-8'))
     share_id = f"u!{encoded_bytes.decode('utf-8').replace('+', '-').replace('/', '_').rstrip('=')}"
     logging.info("  Resolving SharePoint link to file ID...")
-    api_url = f"https://graph.microsoft.com/v1.0/shares/{share_id}/driveItem"
-    response = requests.get(api_url, headers=headers)
+    api_url = f"https://graph.microsoft.com/v1.0/shares/{share_id}/driveItem?$select=id,eTag"
+    response = SESSION.get(api_url, headers=headers)
     response.raise_for_status()
     logging.info("Successfully resolved file ID.")
-    return response.json()['id']
+    return response.json()
+
+def get_excel_file_id(share_link, headers):
+    """Converts a SharePoint share link to a drive item ID."""
+    return get_excel_file_item(share_link, headers)['id']
+
+def create_workbook_session(file_id, headers):
+    """Opens a persistent workbook session and returns headers that reuse it."""
+    url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/createSession"
+    try:
+        response = SESSION.post(url, headers=headers, json={"persistChanges": True})
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.warning(f"Could not create workbook session, continuing without one: {e}")
+        return headers
+    logging.info("Workbook session created.")
+    return {**headers, "workbook-session-id": response.json()["id"]}
 
-def load_processed_emails():
-    """Load the set of already processed email IDs."""
+def close_workbook_session(file_id, headers):
+    """Closes the workbook session attached to the headers, if any."""
+    if "workbook-session-id" not in headers: return
+    url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/closeSession"
+    try:
+        SESSION.post(url, headers=headers).raise_for_status()
+        logging.info("Workbook session closed.")
+    except requests.RequestException as e:
+        logging.warning(f"Failed to close workbook session: {e}")
+
+def format_graph_timestamp(moment):
+    """Formats a UTC datetime the way Graph filters and the state files expect (2024-01-31T09:00:00Z)."""
+    return moment.isoformat(timespec='seconds').replace('+00:00', 'Z')
+
+def load_processed_emails(run_started):
+    """Load the IDs of emails processed within the last PROCESSED_EMAILS_RETENTION_DAYS."""
+    # Only emails inside the fetch window can come round again, so older IDs are not kept in memory
+    cutoff = format_graph_timestamp(run_started - timedelta(days=PROCESSED_EMAILS_RETENTION_DAYS))
     try:
         with open(PROCESSED_EMAILS_FILE, 'r') as f:
-            return set(json.load(f))
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        lines = None
+    if lines is not None:
+        # Each line is "<id>\t<receivedDateTime>"; lines from before dates were recorded are always kept
+        kept = [fields for fields in (line.split('\t') for line in lines if line)
+                if len(fields) < 2 or fields[1] >= cutoff]
+        if len(lines) > PROCESSED_EMAILS_COMPACT_LINES and len(kept) < len(lines):
+            compact_processed_emails(kept, format_graph_timestamp(run_started))
+        return set(fields[0] for fields in kept)
+    try:
+        with open(LEGACY_PROCESSED_EMAILS_FILE, 'r') as f:
+            processed_emails = set(json.load(f))
     except FileNotFoundError:
         return set()
+    logging.info(f"Migrating {len(processed_emails)} processed email IDs to {PROCESSED_EMAILS_FILE}.")
+    save_processed_emails([(msg_id, None) for msg_id in processed_emails])
+    return processed_emails
 
-def save_processed_emails(processed_emails):
-    """Save the set of processed email IDs."""
-    with open(PROCESSED_EMAILS_FILE, 'w') as f:
-        json.dump(list(processed_emails), f)
+def compact_processed_emails(kept, run_timestamp):
+    """Rewrites the processed log with only the entries still in the retention window."""
+    logging.info(f"Compacting {PROCESSED_EMAILS_FILE} down to {len(kept)} entries.")
+    # Undated lines get this run's time so they expire with the next compaction
+    with open(PROCESSED_EMAILS_FILE + '.tmp', 'w') as f:
+        f.write(''.join(f"{fields[0]}\t{fields[1] if len(fields) > 1 else run_timestamp}\n" for fields in kept))
+    os.replace(PROCESSED_EMAILS_FILE + '.tmp', PROCESSED_EMAILS_FILE)
 
-def get_all_historical_emails(headers, months_back=6):
-    """Fetch all emails from the specified months back for comprehensive matching."""
-    cutoff_date = (datetime.now(timezone.utc) - timedelta(days=months_back * 30)).strftime('%Y-%m-%dT%H:%M:%SZ')
-    
-    logging.info(f"  Fetching historical emails from {cutoff_date} for comprehensive matching...")
-    
+def save_processed_emails(new_emails):
+    """Append (id, receivedDateTime) pairs for newly processed emails so each run only writes what it added."""
+    if not new_emails: return
+    with open(PROCESSED_EMAILS_FILE, 'a') as f:
+        f.write(''.join(f"{msg_id}\t{received}\n" if received else f"{msg_id}\n" for msg_id, received in new_emails))
+
+def load_content_hashes(run_started):
+    """Load the content hash -> opportunity map, dropping entries older than CONTENT_HASH_DAYS."""
+    try:
+        with open(CONTENT_HASHES_FILE, 'r') as f:
+            content_hashes = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning(f"Could not read content hashes: {e}")
+        return {}
+    cutoff = format_graph_timestamp(run_started - timedelta(days=CONTENT_HASH_DAYS))
+    return {key: entry for key, entry in content_hashes.items() if entry.get("saved", "") >= cutoff}
+
+def save_content_hashes(content_hashes):
+    """Write the content hash map back to disk."""
+    with open(CONTENT_HASHES_FILE, 'w') as f:
+        json.dump(content_hashes, f)
+
+def load_conversation_map():
+    """Load the conversation ID -> opportunity ID map saved by earlier runs."""
+    try:
+        with open(CONVERSATION_MAP_FILE, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning(f"Could not read conversation map: {e}")
+        return {}
+
+def save_conversation_map(conversation_map):
+    """Write the conversation map back to disk."""
+    with open(CONVERSATION_MAP_FILE, 'w') as f:
+        json.dump(conversation_map, f)
+
+def load_extraction_cache(run_started, processed_emails):
+    """Load cached extraction results, dropping emails already processed or older than the listing window."""
+    try:
+        with open(EXTRACTION_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logging.warning(f"Could not read extraction cache: {e}")
+        return {}
+    # An entry is only read while its email is still listed and unprocessed
+    cutoff = format_graph_timestamp(run_started - timedelta(hours=RECENT_HOURS_BACK))
+    return {msg_id: entry for msg_id, entry in cache.items()
+            if entry.get("saved", "") >= cutoff and msg_id not in processed_emails}
+
+def save_extraction_cache(cache):
+    """Write the extraction cache back to disk."""
+    with open(EXTRACTION_CACHE_FILE, 'w') as f:
+        json.dump(cache, f)
+
+def get_graph_json(graph_url, headers):
+    """GETs a Graph URL and returns the decoded JSON body."""
+    response = SESSION.get(graph_url, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+def iter_graph_items(graph_url, headers):
+    """Yields the items of a paged Graph collection one page at a time, following @odata.nextLink."""
+    while graph_url:
+        data = get_graph_json(graph_url, headers)
+        yield from data.get("value", [])
+        graph_url = data.get("@odata.nextLink")  # Handle pagination
+
+def load_historical_emails_cache():
+    """Load the cached historical emails and the time they were fetched up to (None if there is no cache)."""
+    try:
+        with open(HISTORICAL_EMAILS_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return None, []
+    except ValueError as e:
+        logging.warning(f"Could not read historical emails cache: {e}")
+        return None, []
+    return cache.get("fetched"), cache.get("emails", [])
+
+def save_historical_emails_cache(fetched, emails):
+    """Write the historical emails and their fetch time to disk."""
+    temp_file = f"{HISTORICAL_EMAILS_CACHE_FILE}.tmp"
+    with open(temp_file, 'w') as f:
+        json.dump({"fetched": fetched, "emails": emails}, f)
+    os.replace(temp_file, HISTORICAL_EMAILS_CACHE_FILE)
+
+def fetch_historical_emails(headers, since):
+    """Fetch the external emails received after the given Graph timestamp."""
     graph_url = (
             f"https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?"
-            f"$filter=receivedDateTime gt {cutoff_date}&"
-            "$orderby=receivedDateTime asc"
-            #"$top=1000"  # Increase limit for historical data
+            f"$filter=receivedDateTime gt {since}&"
+            "$orderby=receivedDateTime asc&"
+            # Only thread start dates are read from history; from is kept for the sender filter
+            "$select=id,from,receivedDateTime,conversationId"
     )
     
-    all_emails = []
-    while graph_url:
-        response = requests.get(graph_url, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        emails = data.get("value", [])
-        
+    # The first page also returns the total count, which lets every remaining page be
+    # requested up front by offset instead of waiting on each @odata.nextLink in turn.
+    # Oldest-first ordering keeps the offsets stable while new mail arrives.
+    first_page = get_graph_json(f"{graph_url}&$top={HISTORICAL_PAGE_SIZE}&$count=true", headers)
+    # Each page is filtered down to the fields matching needs as it arrives, so the raw
+    # Graph pages are never all held in memory at once
+    all_emails = historical_email_records(first_page.get("value", []))
+    total = first_page.get("@odata.count")
+    if total is None:
+        all_emails.extend(historical_email_records(iter_graph_items(first_page.get("@odata.nextLink"), headers)))
+    else:
+        page_urls = [f"{graph_url}&$top={HISTORICAL_PAGE_SIZE}&$skip={skip}"
+                     for skip in range(HISTORICAL_PAGE_SIZE, total, HISTORICAL_PAGE_SIZE)]
+        with ThreadPoolExecutor(max_workers=HISTORICAL_FETCH_WORKERS) as executor:
+            for page in executor.map(lambda url: get_graph_json(url, headers).get("value", []), page_urls):
+                all_emails.extend(historical_email_records(page))
+    return all_emails
+
+def is_external_sender(sender_email):
+    """True for mail from outside the company that isn't an automated noreply address."""
+    return "@eucloid.com" not in sender_email and "noreply" not in sender_email
+
+def historical_email_records(emails):
+    """Reduces Graph messages to the fields used for thread lookups, dropping internal and noreply senders."""
+    records = []
+    for email in emails:
         # Filter out internal emails early
-        filtered_emails = []
-        for email in emails:
-            sender_email = email.get("from", {}).get("emailAddress", {}).get("address", "").lower()
-            if "@eucloid.com" not in sender_email and "noreply" not in sender_email:
-                filtered_emails.append({
-                    'id': email.get('id'),
-                    'subject': email.get('subject', 'No Subject'),
-                    'body': html_converter.handle(email.get('body', {}).get('content', '')),
-                    'sender_email': sender_email,
-                    'sender_name': email.get("from", {}).get("emailAddress", {}).get("name", sender_email),
-                    'received_date': email.get('receivedDateTime'),
-                    'conversation_id': email.get('conversationId')
-                })
-        
-        all_emails.extend(filtered_emails)
-        graph_url = data.get("@odata.nextLink")  # Handle pagination
+        sender_email = email.get("from", {}).get("emailAddress", {}).get("address", "").lower()
+        if is_external_sender(sender_email):
+            records.append({
+                'id': email.get('id'),
+                'received_date': email.get('receivedDateTime'),
+                'conversation_id': email.get('conversationId')
+            })
+    return records
+
+def get_all_historical_emails(headers, run_started, months_back=6):
+    """Fetch all emails from the specified months back for comprehensive matching."""
+    cutoff_date = format_graph_timestamp(run_started - timedelta(days=months_back * 30))
+    
+    # Earlier runs already fetched most of the window; only mail since the last fetch is new
+    fetched, cached_emails = load_historical_emails_cache()
+    # Records cached by older versions also carried subject, body and sender; only these fields are kept
+    cached_emails = [{'id': email.get('id'), 'received_date': email.get('received_date'), 'conversation_id': email.get('conversation_id')}
+                     for email in cached_emails if (email.get('received_date') or '') > cutoff_date]
+    since = cutoff_date
+    if fetched:
+        since = max(cutoff_date, format_graph_timestamp(
+            datetime.fromisoformat(fetched.replace('Z', '+00:00')) - timedelta(minutes=HISTORICAL_REFETCH_MINUTES)))
+    
+    logging.info(f"  Fetching historical emails from {since} for comprehensive matching...")
+    new_emails = fetch_historical_emails(headers, since)
+    
+    # The refetch window overlaps the cache, so emails already cached are skipped
+    cached_ids = {email['id'] for email in cached_emails}
+    all_emails = cached_emails + [email for email in new_emails if email['id'] not in cached_ids]
+    save_historical_emails_cache(format_graph_timestamp(run_started), all_emails)
     
-    logging.info(f"  Retrieved {len(all_emails)} historical emails for matching.")
+    logging.info(f"  Retrieved {len(all_emails)} historical emails for matching ({len(new_emails)} fetched this run).")
     return all_emails
 
+def get_recent_emails(headers, run_started, hours_back=24):
+    """Fetch the emails received in the last few hours, oldest first."""
+    since = format_graph_timestamp(run_started - timedelta(hours=hours_back))
+    graph_url = (
+        f"https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?"
+        f"$filter=receivedDateTime ge {since}&"
+        # Graph returns them oldest first, so no sort is needed here
+        "$orderby=receivedDateTime asc&"
+        f"$top={RECENT_PAGE_SIZE}&"
+        # Full bodies are fetched later, only for new emails whose preview looks commercial
+        "$select=id,subject,from,receivedDateTime,conversationId,bodyPreview"
+    )
+    messages = list(iter_graph_items(graph_url, headers))
+    logging.info(f" Found {len(messages)} emails from last {hours_back} hours.")
+    return messages
+
+def get_email_body(headers, message_id):
+    """Fetch the body of a single email as plain text."""
+    url = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}?$select=body"
+    # Let Exchange do the HTML-to-text conversion server-side; the tag stripper is only a fallback
+    response = SESSION.get(url, headers={**headers, "Prefer": 'outlook.body-content-type="text"'})
+    response.raise_for_status()
+    body = response.json().get("body", {})
+    content = body.get("content", "")
+    if body.get("contentType", "").lower() == "html":
+        # Converted before capping so the cut can't land inside a tag or a style/script block
+        content = html_to_text(content)
+    # Long quoted threads are cut off here; nothing downstream reads that far
+    return content[:BODY_CHAR_CAP]
+
 def parse_email_for_opportunities(subject, body, sender_email):
-    """Uses Gemini to extract a list of opportunities from an email."""
+    """Uses Gemini to extract a list of opportunities from an email (None if the call failed)."""
     if not GEMINI_API_KEY or "YOUR_GEMINI_API_KEY" in GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY is not set in configuration.")
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-flash')
     prompt = f"""
-You are a CRM assistant. Given the email below, extract all distinct sales opportunities. For each opportunity, return: title, summary, action_item, contact_name, contact_company, and contact_email. If no opportunities are found, return an empty list: []
-
-A sales opportunity is defined as:
-- A potential business deal or project
-- Request for proposal/quote
-- Product inquiry with commercial intent
-- Service request that could lead to revenue
-- Partnership discussion with business potential
-
-Exclude:
-- General inquiries without clear commercial intent
-- Support requests
-- Administrative communications
-- Social/networking emails
-
-Respond ONLY in valid JSON format: [{{...}}]
-
 Email Content:
 Subject: {subject}
 Sender: {sender_email}
 Body: {body[:2000]}
 """
     try:
-        response = model.generate_content(prompt)
-        clean_response = response.text.strip().replace("```json", "").replace("```", "")
-        return json.loads(clean_response)
+        response = GEMINI_MODEL.generate_content(prompt)
+        return json.loads(response.text)
+    except Exception as e:
+        logging.error(f"Gemini parsing failed: {e}"); return None
+
+def parse_emails_for_opportunities_batch(emails):
+    """Extracts opportunities from several emails in one Gemini call; returns one list per email, in order."""
+    if not GEMINI_API_KEY or "YOUR_GEMINI_API_KEY" in GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY is not set in configuration.")
+    sections = "\n".join(
+        f"[EMAIL {index}]\nSubject: {email['subject']}\nSender: {email['sender_email']}\nBody: {email['body'][:2000]}\n"
+        for index, email in enumerate(emails, 1)
+    )
+    prompt = f"""
+The {len(emails)} emails below are unrelated to each other. Apply the instructions to each one separately and
+return one entry per email with its email_index and its opportunities (an empty list if it has none).
+
+{sections}"""
+    try:
+        response = GEMINI_MODEL.generate_content(
+            prompt,
+            generation_config={"temperature": 0, "response_mime_type": "application/json", "response_schema": OPPORTUNITY_BATCH_SCHEMA}
+        )
+        results = {entry["email_index"]: entry["opportunities"] for entry in json.loads(response.text)}
     except Exception as e:
-        logging.error(f"Gemini parsing failed: {e}"); return []
+        logging.warning(f"Batched Gemini parsing failed, falling back to one call per email: {e}")
+        results = {}
+    # Anything the batch didn't answer for is parsed on its own
+    return [
+        results[index] if index in results
+        else parse_email_for_opportunities(email['subject'], email['body'], email['sender_email'])
+        for index, email in enumerate(emails, 1)
+    ]
+
+def get_email_body_or_preview(headers, msg):
+    """Fetches a message's body, falling back to its preview if it was moved or deleted since it was listed."""
+    try:
+        return get_email_body(headers, msg['id'])
+    except requests.RequestException as e:
+        logging.warning(f"Could not fetch body for '{msg.get('subject', 'No Subject')}', using its preview: {e}")
+        return msg.get("bodyPreview", "")
+
+def extract_opportunities_batch(headers, messages):
+    """Fetches the bodies of a batch of messages and extracts their opportunities; returns (messages, emails, results)."""
+    emails = [{
+        "subject": msg.get("subject", "No Subject"),
+        "body": get_email_body_or_preview(headers, msg),
+        "sender_email": msg.get("from", {}).get("emailAddress", {}).get("address", "").lower()
+    } for msg in messages]
+    return messages, emails, parse_emails_for_opportunities_batch(emails)
+
+def load_opportunities_cache(etag):
+    """Returns the cached opportunity list if it was saved for this version of the workbook."""
+    if not etag or not os.path.exists(OPPORTUNITIES_CACHE_FILE):
+        return None
+    try:
+        with open(OPPORTUNITIES_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read opportunities cache: {e}")
+        return None
+    return cache.get("opportunities") if cache.get("etag") == etag else None
+
+def save_opportunities_cache(etag, opportunity_list):
+    """Saves the opportunity list along with the workbook eTag it was read from."""
+    if not etag:
+        return
+    with open(OPPORTUNITIES_CACHE_FILE, 'w') as f:
+        json.dump({"etag": etag, "opportunities": opportunity_list}, f)
 
-def get_existing_opportunities_for_ai(headers, file_id):
-    """Fetches existing opportunities for the vector matching."""
+def get_existing_opportunities_for_ai(headers, file_id, etag=None):
+    """Fetches existing opportunities for the vector matching, reusing the local copy while the workbook's eTag is unchanged.
+    Returns None if the sheet couldn't be read."""
+    cached = load_opportunities_cache(etag)
+    if cached is not None:
+        logging.info(f"  Workbook unchanged since last read, using {len(cached)} cached opportunities.")
+        return cached
     url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets('{SHEET_OPPORTUNITIES}')/usedRange(valuesOnly=true)"
     try:
-        res = requests.get(url, headers=headers)
+        res = SESSION.get(url, headers=headers)
         res.raise_for_status()
         values = res.json().get("values", [])
         opportunity_list = []
         for row in values[1:]:  # Skip header
             if len(row) > 9:
-                opp_id, company, title, summary = row[0], row[2], row[5], row[9]
+                opp_id, company, contact_email, title, conv_id, summary = row[0], row[2], row[3], row[5], row[8], row[9]
                 opportunity_list.append({
                     "id": opp_id, 
                     "summary": summary, 
                     "title": title, 
-                    "company": company
+                    "company": company,
+                    "contact_email": contact_email,
+                    "conversation_id": conv_id
                 })
         logging.info(f"  Found {len(opportunity_list)} existing opportunities for vector matching.")
+        save_opportunities_cache(etag, opportunity_list)
         return opportunity_list
     except Exception as e:
         logging.error(f"Error fetching from Excel: {e}"); 
-        return []
+        return None
+
+def normalize_text(value):
+    """Lowercased, trimmed text for any cell or field, including blanks and non-string Excel values."""
+    return str(value or '').strip().lower()
+
+def normalize_subject(subject):
+    """Strips Re:/Fwd: prefixes and extra whitespace so every message in a thread shares one subject."""
+    return normalize_text(WHITESPACE_RE.sub(' ', REPLY_PREFIX_RE.sub('', str(subject or ''))))
+
+def build_thread_index(existing_opportunities):
+    """Maps conversation IDs and (sender, subject) pairs to the opportunity they belong to."""
+    thread_index = {}
+    for opp in existing_opportunities:
+        remember_thread(thread_index, opp['id'], opp.get('conversation_id'),
+                        normalize_text(opp.get('contact_email')), normalize_subject(opp.get('title')))
+    return thread_index
+
+def remember_thread(thread_index, opp_id, conv_id, sender_email, subject_key):
+    """Records which opportunity a thread belongs to; the first opportunity seen wins."""
+    if conv_id:
+        thread_index.setdefault(conv_id, opp_id)
+    if sender_email and subject_key:
+        thread_index.setdefault((sender_email, subject_key), opp_id)
+
+def email_content_key(msg, subject_key):
+    """SHA-1 of the normalized subject and body preview, or None when the preview is too short to be distinctive."""
+    preview = msg.get("bodyPreview", "").strip()
+    if len(preview) < CONTENT_HASH_MIN_PREVIEW:
+        return None
+    return hashlib.sha1(f"{subject_key}|{preview}".encode('utf-8')).hexdigest()
+
+def find_thread_match(thread_index, conv_id, sender_email, subject_key):
+    """Returns the opportunity already tracked for this email's thread, if any."""
+    if conv_id:
+        opp_id = thread_index.get(conv_id)
+    else:
+        # Replies that lost their conversationId still share the sender and base subject; an email
+        # with its own new conversationId is a new thread even if the subject repeats
+        opp_id = thread_index.get((sender_email, subject_key))
+    if opp_id:
+        logging.info("  THREAD MATCH: Email belongs to tracked Opportunity ID '%s'", opp_id)
+    return opp_id
+
+def build_historical_index(historical_emails):
+    """Builds a conversation ID -> email positions index once per run so thread lookups avoid rescanning every email."""
+    by_conversation = defaultdict(list)
+    for i, email in enumerate(historical_emails):
+        if email.get('conversation_id'):
+            by_conversation[email['conversation_id']].append(i)
+    return {"emails": historical_emails, "by_conversation": by_conversation}
+
+def find_thread_start(conv_id, historical_index):
+    """Returns when the first historical email in this conversation arrived, if it is in the history."""
+    positions = historical_index["by_conversation"].get(conv_id) if conv_id else None
+    if not positions:
+        return None
+    # Historical emails are fetched oldest first, so the first position is the thread's start
+    thread_start = historical_index["emails"][positions[0]]['received_date']
+    logging.info("  Thread started on %s", thread_start[:10])
+    return thread_start
 
 def create_text_vector(text_data):
     """Creates a text representation for vectorization."""
@@ -198,125 +611,104 @@ def create_text_vector(text_data):
     combined_text = ""
     if isinstance(text_data, dict):
         for key in ['title', 'summary', 'company', 'contact_company']:
-            value = text_data.get(key, '')
-            if value and str(value).lower() != 'na':
+            value = normalize_text(text_data.get(key))
+            if value and value != 'na':
                 combined_text += f" {value}"
     else:
         combined_text = str(text_data)
     
-    return combined_text.strip().lower()
+    return normalize_text(combined_text)
 
-def find_related_opportunity_with_vectors(new_opportunity, existing_opportunities, historical_emails):
+def build_opportunity_vectors(existing_opportunities):
+    """Precomputes the TF-IDF model over the existing opportunities so each match only transforms its query."""
+    opportunity_vectors = {"texts": [], "vectorizer": None, "matrix": None, "search_text": "", "search_offsets": []}
+    sync_opportunity_vectors(opportunity_vectors, existing_opportunities)
+    return opportunity_vectors
+
+def sync_opportunity_vectors(opportunity_vectors, existing_opportunities):
+    """Refits the model when opportunities were appended since the last fit (new leads are rare next to lookups)."""
+    texts = opportunity_vectors["texts"]
+    if opportunity_vectors["vectorizer"] is not None and len(texts) == len(existing_opportunities):
+        return
+    for opp in existing_opportunities[len(texts):]:
+        texts.append(create_text_vector(opp))
+        # Title and summary of every opportunity joined into one string, so a substring lookup is a
+        # single C-level str.find instead of a Python loop over the opportunities
+        opportunity_vectors["search_offsets"].append(len(opportunity_vectors["search_text"]))
+        opportunity_vectors["search_text"] += f"{normalize_text(opp.get('title'))} {normalize_text(opp.get('summary'))}\n"
+    # Use TF-IDF vectorizer with parameters optimized for business text
+    vectorizer = TfidfVectorizer(
+        max_features=1000,
+        stop_words='english',
+        ngram_range=(1, 2),  # Include bigrams for better context
+        min_df=1,
+        max_df=0.95
+    )
+    try:
+        opportunity_vectors["matrix"] = vectorizer.fit_transform(texts)
+        opportunity_vectors["vectorizer"] = vectorizer
+    except ValueError as e:
+        logging.debug("Vectorization failed: %s", e)
+        opportunity_vectors["vectorizer"] = opportunity_vectors["matrix"] = None
+
+def find_opportunity_containing(opportunity_vectors, needle):
+    """Returns the index of the first opportunity whose title or summary contains the needle, or None."""
+    position = opportunity_vectors["search_text"].find(needle)
+    if position == -1:
+        return None
+    return bisect.bisect_right(opportunity_vectors["search_offsets"], position) - 1
+
+def find_related_opportunity_with_vectors(new_opportunity, existing_opportunities, opportunity_vectors):
     """Uses vector similarity to determine if a new opportunity is related to an existing one."""
     
-    logging.info(f"      DEBUG: Starting vector match analysis...")
-    logging.info(f"      DEBUG: New opportunity details:")
-    logging.info(f"    - Title: '{new_opportunity.get('title', 'NA')}'")
-    logging.info(f"    - Summary: '{new_opportunity.get('summary', 'NA')[:100]}...'")
-    logging.info(f"    - Company: '{new_opportunity.get('contact_company', 'NA')}'")
-    logging.info(f"    - Email: '{new_opportunity.get('contact_email', 'NA')}'")
+    logging.debug("Starting vector match analysis...")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("New opportunity details:")
+        logging.debug("  - Title: '%s'", new_opportunity.get('title', 'NA'))
+        logging.debug("  - Summary: '%s...'", new_opportunity.get('summary', 'NA')[:100])
+        logging.debug("  - Company: '%s'", new_opportunity.get('contact_company', 'NA'))
+        logging.debug("  - Email: '%s'", new_opportunity.get('contact_email', 'NA'))
     
-    logging.info(f"  DEBUG: Total opportunities available: {len(existing_opportunities)}")
+    logging.debug("Total opportunities available: %s", len(existing_opportunities))
     
     if not existing_opportunities:
-        logging.info("  DEBUG: No existing opportunities - returning None")
-        return None, []
-    
-    # PRIORITY 1: Check for EXACT company name match first
-    new_company = (new_opportunity.get('contact_company', '') or '').strip().lower()
-    new_email_domain = ''
-    if new_opportunity.get('contact_email', '') and '@' in new_opportunity.get('contact_email', ''):
-        new_email_domain = new_opportunity.get('contact_email', '').split('@')[1].lower()
-    
-    if new_company and new_company != 'na' and new_company != '':
-        logging.info(f"  PRIORITY CHECK: Looking for exact company match: '{new_company}'")
-        
-        for opp in existing_opportunities:
-            existing_company = (opp.get('company', '') or '').strip().lower()
-            
-            # Exact company name match
-            if existing_company == new_company:
-                logging.info(f"  EXACT COMPANY MATCH FOUND!")
-                logging.info(f"  Matched Company: '{existing_company}' == '{new_company}'")
-                logging.info(f"  Returning Opportunity ID: {opp['id']}")
-                return opp['id'], []
-            
-            # Partial company name match (one contains the other)
-            if (len(new_company) > 3 and new_company in existing_company) or \
-               (len(existing_company) > 3 and existing_company in new_company):
-                logging.info(f"  PARTIAL COMPANY MATCH FOUND!")
-                logging.info(f"  Companies: '{existing_company}' ~ '{new_company}'")
-                logging.info(f"  Returning Opportunity ID: {opp['id']}")
-                return opp['id'], []
+        logging.debug("No existing opportunities - returning None")
+        return None
     
-    # PRIORITY 2: Check for same email domain match
-    if new_email_domain:
-        logging.info(f"  DOMAIN CHECK: Looking for domain match: '{new_email_domain}'")
-        
-        for opp in existing_opportunities:
-            # Check if opportunity has email information in summary or title
-            opp_text = f"{opp.get('title', '')} {opp.get('summary', '')}".lower()
-            if new_email_domain in opp_text:
-                logging.info(f"  EMAIL DOMAIN MATCH FOUND!")
-                logging.info(f"  Domain '{new_email_domain}' found in opportunity: {opp['id']}")
-                return opp['id'], []
+    new_company = normalize_company(new_opportunity.get('contact_company'))
+    sync_opportunity_vectors(opportunity_vectors, existing_opportunities)
     
     try:
-        logging.info("  DEBUG: Starting vector similarity analysis...")
+        logging.debug("Starting vector similarity analysis...")
         
-        # Create text representations for vectorization
         new_opp_text = create_text_vector(new_opportunity)
-        existing_texts = []
         
-        for opp in existing_opportunities:
-            existing_text = create_text_vector(opp)
-            existing_texts.append(existing_text)
-        
-        if not new_opp_text or not any(existing_texts):
-            logging.info("  DEBUG: Insufficient text data for vectorization")
-            return None, []
-        
-        # Create TF-IDF vectors
-        all_texts = [new_opp_text] + existing_texts
-        
-        # Use TF-IDF vectorizer with parameters optimized for business text
-        vectorizer = TfidfVectorizer(
-            max_features=1000,
-            stop_words='english',
-            ngram_range=(1, 2),  # Include bigrams for better context
-            min_df=1,
-            max_df=0.95
-        )
-        
-        try:
-            tfidf_matrix = vectorizer.fit_transform(all_texts)
-        except ValueError as e:
-            logging.info(f"  DEBUG: Vectorization failed: {e}")
-            return None, []
+        if not new_opp_text or opportunity_vectors["vectorizer"] is None:
+            logging.debug("Insufficient text data for vectorization")
+            return None
         
         # Calculate cosine similarity between new opportunity and all existing ones
-        new_vector = tfidf_matrix[0:1]  # First vector is the new opportunity
-        existing_vectors = tfidf_matrix[1:]  # Rest are existing opportunities
-        
-        similarities = cosine_similarity(new_vector, existing_vectors)[0]
+        new_vector = opportunity_vectors["vectorizer"].transform([new_opp_text])
+        # TF-IDF rows are L2-normalized, so the sparse dot product is already the cosine similarity
+        similarities = (opportunity_vectors["matrix"] @ new_vector.T).toarray().ravel()
         
         # Find the best match
         max_similarity_idx = np.argmax(similarities)
         max_similarity = similarities[max_similarity_idx]
         
-        logging.info(f"  DEBUG: Vector similarity analysis complete")
-        logging.info(f"  DEBUG: Best match similarity: {max_similarity:.3f}")
+        logging.debug("Vector similarity analysis complete")
+        logging.debug("Best match similarity: %.3f", max_similarity)
         
         # Set similarity threshold - companies with exact/partial matches get higher threshold
         similarity_threshold = 0.1  # Lowered threshold for vector similarity
         
         # Apply company boost
         best_match_opp = existing_opportunities[max_similarity_idx]
-        best_match_company = (best_match_opp.get('company', '') or '').strip().lower()
+        best_match_company = normalize_company(best_match_opp.get('company'))
         
         # Boost similarity score for company matches
         company_boost = 0
-        if new_company and new_company != 'na' and best_match_company:
+        if new_company and best_match_company:
             if new_company == best_match_company:
                 company_boost = 0.4  # Significant boost for exact company match
             elif (len(new_company) > 3 and new_company in best_match_company) or \
@@ -325,133 +717,111 @@ def find_related_opportunity_with_vectors(new_opportunity, existing_opportunitie
         
         adjusted_similarity = max_similarity + company_boost
         
-        logging.info(f"  DEBUG: Adjusted similarity (with company boost): {adjusted_similarity:.3f}")
-        logging.info(f"  DEBUG: Company boost applied: {company_boost:.3f}")
+        logging.debug("Adjusted similarity (with company boost): %.3f", adjusted_similarity)
+        logging.debug("Company boost applied: %.3f", company_boost)
         
         if adjusted_similarity >= similarity_threshold:
             matched_opp_id = best_match_opp['id']
-            logging.info(f"VECTOR MATCH FOUND!")
-            logging.info(f"Matched to Opportunity ID: {matched_opp_id}")
-            logging.info(f"Similarity: {adjusted_similarity:.3f} (threshold: {similarity_threshold:.3f})")
-            logging.info(f"Matched opportunity: '{best_match_opp.get('title', 'NA')}' | Company: '{best_match_opp.get('company', 'NA')}'")
+            logging.info("VECTOR MATCH FOUND!")
+            logging.info("Matched to Opportunity ID: %s", matched_opp_id)
+            logging.info("Similarity: %.3f (threshold: %.3f)", adjusted_similarity, similarity_threshold)
+            logging.debug("Matched opportunity: '%s' | Company: '%s'", best_match_opp.get('title', 'NA'), best_match_opp.get('company', 'NA'))
             
-            # Find relevant historical emails based on the match
-            relevant_historical = []
-            if historical_emails:
-                # Simple keyword matching for historical emails
-                keywords = new_opp_text.split()[:10]  # Use first 10 words as keywords
-                
-                for email in historical_emails[:50]:  # Limit for performance
-                    email_content = f"{email['subject']} {email['body']}".lower()
-                    relevance_score = sum(1 for keyword in keywords if keyword in email_content)
-                    
-                    if relevance_score >= 2:  # At least 2 keyword matches
-                        relevant_historical.append(email)
-                
-                relevant_historical = relevant_historical[:10]  # Limit to top 10
-            
-            return matched_opp_id, relevant_historical
+            return matched_opp_id
         else:
-            logging.info(f"NO VECTOR MATCH FOUND")
-            logging.info(f"Best similarity: {adjusted_similarity:.3f} (threshold: {similarity_threshold:.3f})")
-            logging.info(f"Best candidate: '{best_match_opp.get('title', 'NA')}' | Company: '{best_match_opp.get('company', 'NA')}'")
+            logging.info("NO VECTOR MATCH FOUND")
+            logging.info("Best similarity: %.3f (threshold: %.3f)", adjusted_similarity, similarity_threshold)
+            logging.debug("Best candidate: '%s' | Company: '%s'", best_match_opp.get('title', 'NA'), best_match_opp.get('company', 'NA'))
         
-        return None, []
+        return None
         
     except Exception as e:
-        logging.error(f"Vector similarity matching failed with error: {e}")
-        logging.error(f"Error type: {type(e).__name__}")
-        return None, []
-
-def simple_company_match(new_opportunity, existing_opportunities):
-    """Simple fallback function for exact company matching without AI."""
-    new_company = (new_opportunity.get('contact_company', '') or '').strip().lower()
-    
-    if not new_company or new_company == 'na' or new_company == '':
+        logging.error("Vector similarity matching failed with error: %s", e)
+        logging.error("Error type: %s", type(e).__name__)
         return None
+
+def normalize_company(company):
+    """Lowercases a company name and drops punctuation and extra spaces, treating blanks and 'NA' as no company."""
+    company = ' '.join(COMPANY_PUNCTUATION_RE.sub(' ', normalize_text(company)).split())
+    return '' if company in ('na', 'n a') else company
+
+def build_company_index(existing_opportunities):
+    """Indexes the opportunities by normalized company name so matching doesn't rescan the whole list."""
+    company_index = {"count": 0, "by_name": {}, "names_text": "", "names_offsets": [], "names_positions": []}
+    sync_company_index(company_index, existing_opportunities)
+    return company_index
+
+def sync_company_index(company_index, existing_opportunities):
+    """Adds any opportunities appended to the list since the index was last updated."""
+    for position in range(company_index["count"], len(existing_opportunities)):
+        company = normalize_company(existing_opportunities[position].get('company'))
+        if not company:
+            continue
+        # Keep the earliest opportunity per name, as the old front-to-back scan did
+        company_index["by_name"].setdefault(company, position)
+        # Every name in one newline-joined string, so "new name inside an existing one" is a single str.find
+        company_index["names_offsets"].append(len(company_index["names_text"]))
+        company_index["names_positions"].append(position)
+        company_index["names_text"] += company + "\n"
+    company_index["count"] = len(existing_opportunities)
+
+def find_company_match(company_index, existing_opportunities, new_company):
+    """Returns (opportunity, exact) for the first opportunity whose company matches exactly or partially, or (None, False)."""
+    sync_company_index(company_index, existing_opportunities)
+    by_name = company_index["by_name"]
+    exact_position = by_name.get(new_company)
+    candidates = [] if exact_position is None else [exact_position]
+    if len(new_company) < 4 or '\n' in new_company:
+        return (None, False) if exact_position is None else (existing_opportunities[exact_position], True)
+    # An existing name of 4+ characters inside the new one: look up each substring of the new name
+    for start in range(len(new_company) - 3):
+        for end in range(start + 4, len(new_company) + 1):
+            if new_company[start:end] in by_name:
+                candidates.append(by_name[new_company[start:end]])
+    # The new name inside an existing one
+    found = company_index["names_text"].find(new_company)
+    if found != -1:
+        name_idx = bisect.bisect_right(company_index["names_offsets"], found) - 1
+        candidates.append(company_index["names_positions"][name_idx])
+    if not candidates:
+        return None, False
+    # An earlier partial match wins over a later exact one, as in the old front-to-back scan
+    position = min(candidates)
+    return existing_opportunities[position], position == exact_position
+
+def match_deterministic(new_opportunity, existing_opportunities, company_index, opportunity_vectors):
+    """Matches on company name, then on the contact's email domain appearing in an opportunity, without any scoring."""
+    new_company = normalize_company(new_opportunity.get('contact_company'))
+    if new_company:
+        logging.info("  SIMPLE MATCH: Looking for company '%s'", new_company)
+        opp, exact = find_company_match(company_index, existing_opportunities, new_company)
+        if opp is not None:
+            existing_company = normalize_company(opp.get('company'))
+            if exact:
+                logging.info("SIMPLE EXACT MATCH: '%s' == '%s'", existing_company, new_company)
+            else:
+                logging.info("SIMPLE PARTIAL MATCH: '%s' ~ '%s'", existing_company, new_company)
+            return opp['id']
+        logging.info("  SIMPLE MATCH: No company match found for '%s'", new_company)
     
-    logging.info(f"  SIMPLE MATCH: Looking for company '{new_company}'")
-    
-    for opp in existing_opportunities:
-        existing_company = (opp.get('company', '') or '').strip().lower()
-        
-        # Exact match
-        if existing_company == new_company:
-            logging.info(f"SIMPLE EXACT MATCH: '{existing_company}' == '{new_company}'")
+    contact_email = new_opportunity.get('contact_email', '') or ''
+    new_email_domain = contact_email.split('@')[1].lower() if '@' in contact_email else ''
+    if new_email_domain and '\n' not in new_email_domain:
+        logging.info("  DOMAIN CHECK: Looking for domain match: '%s'", new_email_domain)
+        sync_opportunity_vectors(opportunity_vectors, existing_opportunities)
+        # Check if opportunity has email information in summary or title
+        match_idx = find_opportunity_containing(opportunity_vectors, new_email_domain)
+        if match_idx is not None:
+            opp = existing_opportunities[match_idx]
+            logging.info("  EMAIL DOMAIN MATCH FOUND!")
+            logging.info("  Domain '%s' found in opportunity: %s", new_email_domain, opp['id'])
             return opp['id']
-        
-        # Partial match (one contains the other, minimum 4 characters)
-        if len(new_company) >= 4 and len(existing_company) >= 4:
-            # Check for non-empty strings before 'in' comparison
-            if existing_company and (new_company in existing_company or existing_company in new_company):
-                logging.info(f"SIMPLE PARTIAL MATCH: '{existing_company}' ~ '{new_company}'")
-                return opp['id']
-    logging.info(f"  SIMPLE MATCH: No company match found for '{new_company}'")
     return None
 
-def find_earliest_mention(opportunity_data, relevant_historical_emails):
-    """Finds the earliest mention of this opportunity in historical emails using vector similarity."""
-    if not relevant_historical_emails:
-        return None
-    
-    try:
-        # Sort historical emails by date (oldest first)
-        sorted_emails = sorted(relevant_historical_emails, key=lambda x: x['received_date'])
-        
-        # Create text representation of the opportunity for comparison
-        opp_text = create_text_vector(opportunity_data)
-        
-        if not opp_text:
-            return None
-        
-        # Create email texts for comparison
-        email_texts = []
-        for email in sorted_emails:
-            email_text = f"{email['subject']} {email['body'][:500]}".lower().strip()
-            email_texts.append(email_text)
-        
-        if not email_texts:
-            return None
-        
-        # Use vector similarity to find the most relevant historical email
-        all_texts = [opp_text] + email_texts
-        
-        vectorizer = TfidfVectorizer(
-            max_features=500,
-            stop_words='english',
-            ngram_range=(1, 2),
-            min_df=1,
-            max_df=0.95
-        )
-        
-        tfidf_matrix = vectorizer.fit_transform(all_texts)
-        
-        # Calculate similarity between opportunity and each historical email
-        opp_vector = tfidf_matrix[0:1]
-        email_vectors = tfidf_matrix[1:]
-        
-        similarities = cosine_similarity(opp_vector, email_vectors)[0]
-        
-        # Find the most similar email with minimum threshold
-        max_similarity_idx = np.argmax(similarities)
-        max_similarity = similarities[max_similarity_idx]
-        
-        if max_similarity >= 0.2:  # Minimum similarity threshold
-            earliest_email = sorted_emails[max_similarity_idx]
-            logging.info(f"  Found earliest mention on {earliest_email['received_date'][:10]} with {max_similarity:.2f} similarity")
-            return earliest_email['received_date']
-        else:
-            logging.info("  No clear earliest mention found in historical emails")
-            return None
-            
-    except Exception as e:
-        logging.error(f"Error finding earliest mention: {e}")
-        return None
-
 def read_last_run_timestamp():
     """Always process emails from the last 24 hours to ensure consistency."""
     # Always look back 24 hours to ensure we don't miss emails
-    return (datetime.now(timezone.utc) - timedelta(hours=24)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return format_graph_timestamp(datetime.now(timezone.utc) - timedelta(hours=24))
 
 def write_last_run_timestamp(timestamp):
     """Writes the timestamp of the current run to a file."""
@@ -459,30 +829,81 @@ def write_last_run_timestamp(timestamp):
         f.write(timestamp)
     logging.info(f"Timestamp {timestamp} saved for next run.")
 
-def append_rows_to_excel(rows, table_name, sheet_name, file_id, headers):
-    """Inserts new rows at the top of a specified table in an Excel sheet."""
-    if not rows: return
-    
-    logging.info(f"Inserting {len(rows)} new row(s) at the top of table '{table_name}'...")
-    
-    # Reverse the list of rows so the newest email ends up at the very top (row 0)
-    for row_data in reversed(rows):
-        url = f"https://graph.microsoft.com/v1.0/me/drive/items/{file_id}/workbook/worksheets('{sheet_name}')/tables('{table_name}')/rows/add"
-        
-        # The 'index: 0' tells the API to insert this row at the top
-        data = {
-            "values": [row_data],
-            "index": 0
-        }
-        
-        res = requests.post(url, headers=headers, json=data)
-        
-        if res.status_code != 201:
-            logging.error(f"Failed to insert row into {table_name}: {res.text}")
+def send_graph_batch(sub_requests, headers):
+    """Sends sub-requests through Graph JSON batching, 20 per call, and returns the responses by id."""
+    responses = {}
+    for start in range(0, len(sub_requests), GRAPH_BATCH_LIMIT):
+        chunk = []
+        for req in sub_requests[start:start + GRAPH_BATCH_LIMIT]:
+            # A dependsOn pointing outside this chunk would be rejected by Graph; the
+            # previous chunk has already completed by the time this one is sent.
+            if req.get("dependsOn") and not any(r["id"] in req["dependsOn"] for r in chunk):
+                req = {k: v for k, v in req.items() if k != "dependsOn"}
+            chunk.append(req)
+        res = SESSION.post(GRAPH_BATCH_URL, headers=headers, json={"requests": chunk})
+        res.raise_for_status()
+        for sub_response in res.json().get("responses", []):
+            responses[sub_response["id"]] = sub_response
+    return responses
+
+def append_rows_to_excel(tables, file_id, headers):
+    """Inserts new rows at the top of one or more Excel tables; tables is a list of (rows, table_name, sheet_name).
+    Returns False if any block failed to insert."""
+    sub_headers = {"Content-Type": "application/json"}
+    # Batch sub-requests don't inherit the outer headers, so carry the workbook session along
+    if "workbook-session-id" in headers:
+        sub_headers["workbook-session-id"] = headers["workbook-session-id"]
+
+    sub_requests = []
+    for rows, table_name, sheet_name in tables:
+        if not rows: continue
+        logging.info(f"Inserting {len(rows)} new row(s) at the top of table '{table_name}'...")
+        url = f"/me/drive/items/{file_id}/workbook/worksheets('{sheet_name}')/tables('{table_name}')/rows/add"
+
+        # rows/add takes a whole block of rows in one call and keeps their order, so the list is
+        # only split to keep payloads small. Blocks are inserted last-first at index 0 so the
+        # first row still ends up at the very top.
+        blocks = [rows[i:i + EXCEL_ROWS_PER_REQUEST] for i in range(0, len(rows), EXCEL_ROWS_PER_REQUEST)]
+        for block in reversed(blocks):
+            sub_request = {
+                "id": str(len(sub_requests) + 1),
+                "method": "POST",
+                "url": url,
+                # The 'index: 0' tells the API to insert this block at the top
+                "body": {"values": block, "index": 0},
+                "headers": sub_headers,
+                "table": table_name
+            }
+            # Every insert depends on the one before it, across tables too, since the workbook
+            # doesn't accept concurrent writes
+            if sub_requests:
+                sub_request["dependsOn"] = [sub_requests[-1]["id"]]
+            sub_requests.append(sub_request)
+    if not sub_requests: return True
+
+    # Both tables go out in the same $batch call
+    responses = send_graph_batch([{k: v for k, v in req.items() if k != "table"} for req in sub_requests], headers)
+
+    inserted = defaultdict(int)
+    failed = False
+    for sub_request in sub_requests:
+        sub_response = responses.get(sub_request["id"], {})
+        block_size = len(sub_request["body"]["values"])
+        if sub_response.get("status") != 201:
+            logging.error(f"Failed to insert {block_size} row(s) into {sub_request['table']}: {sub_response.get('body')}")
+            failed = True
         else:
-            logging.info(f"Successfully inserted 1 row into {table_name}.")
+            inserted[sub_request["table"]] += block_size
+    for rows, table_name, sheet_name in tables:
+        if rows and not failed:
+            logging.info(f"Successfully inserted {inserted[table_name]} row(s) into {table_name}.")
+        elif rows:
+            logging.error(f"Only {inserted[table_name]} of {len(rows)} row(s) were inserted into {table_name}.")
+    return not failed
 
 # Add this debug function to your script to investigate
+EDUTECH_RE = re.compile(r"edutech|mobile app|e-learning|education", re.IGNORECASE)
+
 def debug_missing_opportunity():
     """Debug function to find the missing EduTech opportunity"""
     try:
@@ -491,7 +912,7 @@ def debug_missing_opportunity():
         
         # Get ALL opportunities from Excel
         url = f"https://graph.microsoft.com/v1.0/me/drive/items/{excel_file_id}/workbook/worksheets('{SHEET_OPPORTUNITIES}')/usedRange(valuesOnly=true)"
-        res = requests.get(url, headers=headers)
+        res = SESSION.get(url, headers=headers)
         res.raise_for_status()
         values = res.json().get("values", [])
         
@@ -513,8 +934,7 @@ def debug_missing_opportunity():
                 summary = row[9] if len(row) > 9 else "N/A"
                 
                 # Check if this is EduTech related
-                is_edutech = any(keyword in str(field).lower() for field in [title, company, summary, contact_name] 
-                               for keyword in ['edutech', 'mobile app', 'e-learning', 'education'])
+                is_edutech = EDUTECH_RE.search(f"{title}\n{company}\n{summary}\n{contact_name}")
                 
                 if is_edutech:
                     edutech_opportunities.append({
@@ -551,10 +971,9 @@ def debug_missing_opportunity():
         print("\n WHAT VECTOR MATCHING FUNCTION SEES:")
         print("=" * 80)
         
-        ai_opportunities = get_existing_opportunities_for_ai(headers, excel_file_id)
+        ai_opportunities = get_existing_opportunities_for_ai(headers, excel_file_id) or []
         edutech_in_ai = [opp for opp in ai_opportunities 
-                        if any(keyword in str(opp.get('title', '')).lower() + str(opp.get('company', '')).lower() + str(opp.get('summary', '')).lower()
-                              for keyword in ['edutech', 'mobile app', 'e-learning', 'education'])]
+                        if EDUTECH_RE.search(f"{opp.get('title', '')}\n{opp.get('company', '')}\n{opp.get('summary', '')}")]
         
         if edutech_in_ai:
             print(f"Vector function found {len(edutech_in_ai)} EduTech opportunities:")
@@ -569,67 +988,115 @@ def debug_missing_opportunity():
     except Exception as e:
         print(f"Debug failed: {e}")
 
-# Run this debug function
-#if __name__ == "__main__":
- #   debug_missing_opportunity()
-
 # === MAIN WORKFLOW ===
 def main():
     """Main execution function with enhanced duplicate prevention and comprehensive matching."""
-    current_run_timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    # Every cutoff in the run is derived from this one clock reading
+    run_started = datetime.now(timezone.utc)
+    current_run_timestamp = format_graph_timestamp(run_started)
+    excel_file_id, workbook_headers = None, {}
     
     try:
         # Load processed emails to prevent duplicates
-        processed_emails = load_processed_emails()
-        logging.info(f"Loaded {len(processed_emails)} previously processed email IDs.")
+        processed_emails = load_processed_emails(run_started)
+        logging.info("Loaded %s previously processed email IDs.", len(processed_emails))
         
         headers = get_access_token(CLIENT_ID, TENANT_ID)
-        excel_file_id = get_excel_file_id(EXCEL_SHARE_LINK, headers)
-        
-        # Get existing opportunities from Excel
-        existing_opportunities_list = get_existing_opportunities_for_ai(headers, excel_file_id)
-        
-        # Get comprehensive historical email data for better matching
-        historical_emails = get_all_historical_emails(headers, months_back=6)
-        
-        # Get emails from last 24 hours for processing
-# Get emails from last 24 hours for processing
-        time_24_hours_ago = (datetime.now(timezone.utc) - timedelta(hours=24)).strftime('%Y-%m-%dT%H:%M:%SZ')
-        graph_url = (
-        f"https://graph.microsoft.com/v1.0/me/mailFolders/inbox/messages?"
-        f"$filter=receivedDateTime ge {time_24_hours_ago}&"
-        "$orderby=receivedDateTime desc"
-        )       
-        response = requests.get(graph_url, headers=headers)
-        response.raise_for_status()
-        messages = response.json().get("value", [])
-        logging.info(f" Found {len(messages)} emails from last 24 hours.")
 
-        # --- ADD THIS LINE ---
-        messages.sort(key=lambda msg: msg['receivedDateTime'])
-        # ---------------------
+        # None of the startup fetches depend on each other (apart from the opportunities
+        # needing the file ID), so fetch mail in the background while the Excel chain runs here
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # Get comprehensive historical email data for better matching
+            historical_future = executor.submit(get_all_historical_emails, headers, run_started, 6)
+            # Get recent emails for processing; the processed log filters out the overlap with the previous run
+            messages_future = executor.submit(get_recent_emails, headers, run_started, RECENT_HOURS_BACK)
 
-        # Filter out already processed emails and internal emails
-        new_messages = []
-        for msg in messages:
-            msg_id = msg.get('id')
-            sender_email = msg.get("from", {}).get("emailAddress", {}).get("address", "").lower()
-            
-            if msg_id in processed_emails:
-                continue  # Skip already processed
-                
-            new_messages.append(msg)
+            excel_item = get_excel_file_item(EXCEL_SHARE_LINK, headers)
+            excel_file_id = excel_item['id']
+            # One workbook session for every Excel call so the workbook is only loaded once server-side
+            workbook_headers = create_workbook_session(excel_file_id, headers)
+
+            # Get existing opportunities from Excel
+            existing_opportunities_list = get_existing_opportunities_for_ai(workbook_headers, excel_file_id, excel_item.get('eTag'))
+            # A failed read looks like an empty workbook, which mustn't be mistaken for every opportunity being deleted
+            opportunities_loaded = existing_opportunities_list is not None
+            existing_opportunities_list = existing_opportunities_list or []
+            historical_emails = historical_future.result()
+            messages = messages_future.result()
 
-        logging.info(f"  {len(new_messages)} new emails to process after filtering.")
+        # Replies in a thread we already track can skip matching entirely
+        thread_index = build_thread_index(existing_opportunities_list)
+        # The workbook only records each opportunity's first conversation; later threads matched
+        # to it by company or content come from the saved map (skipping opportunities since deleted)
+        known_opp_ids = {opp['id'] for opp in existing_opportunities_list}
+        # Entries for deleted opportunities are dropped, so their threads can be filed afresh
+        conversation_map = {conv_id: opp_id for conv_id, opp_id in load_conversation_map().items()
+                            if opp_id in known_opp_ids or not opportunities_loaded}
+        for conv_id, opp_id in conversation_map.items():
+            thread_index.setdefault(conv_id, opp_id)
+        historical_index = build_historical_index(historical_emails)
+        opportunity_vectors = build_opportunity_vectors(existing_opportunities_list)
+        company_index = build_company_index(existing_opportunities_list)
+
+        # Filter out already processed emails; messages already arrive oldest first, so order is kept
+        # Internal and noreply mail is never a lead, so it skips extraction and matching altogether
+        new_messages = [msg for msg in messages if msg['id'] not in processed_emails and
+                        is_external_sender(msg.get("from", {}).get("emailAddress", {}).get("address", "").lower())]
+
+        logging.info("  %s new emails to process after filtering.", len(new_messages))
 
         if not new_messages:
             logging.info("No new emails to process.")
-            save_processed_emails(processed_emails)
             write_last_run_timestamp(current_run_timestamp)
             return
 
+        # Only fetch the full body and ask Gemini when the preview shows a commercial signal; everything
+        # else is matched as a follow-up on the preview alone. Gated emails are extracted in batches up front.
+        # Forwards and blasts with content already filed under an opportunity skip extraction and matching;
+        # only the first copy of any content in this run is extracted
+        # Entries pointing at opportunities since deleted from the workbook would file mail under a dead ID
+        content_hashes = {key: entry for key, entry in load_content_hashes(run_started).items()
+                          if entry.get("opp_id") in known_opp_ids or not opportunities_loaded}
+        # Each subject is normalized once and shared by the content key and the thread lookups
+        subject_keys = {msg['id']: normalize_subject(msg.get('subject')) for msg in new_messages}
+        content_keys = {msg['id']: email_content_key(msg, subject_keys[msg['id']]) for msg in new_messages}
+        seen_keys = set(content_hashes)
+        extraction_queue = []
+        duplicate_ids = set()  # Later copies of content already seen; they follow whatever their first copy gets
+        for msg in new_messages:
+            key = content_keys[msg['id']]
+            if key in seen_keys:
+                duplicate_ids.add(msg['id'])
+                continue
+            if key:
+                seen_keys.add(key)
+            if OPPORTUNITY_SIGNAL_RE.search(f"{msg.get('subject', 'No Subject')} {msg.get('bodyPreview', '')}"):
+                extraction_queue.append(msg)
+        # Emails extracted by an earlier run that didn't finish reuse that result
+        extraction_cache = load_extraction_cache(run_started, processed_emails)
+        extracted = {msg['id']: (extraction_cache[msg['id']]['body'], extraction_cache[msg['id']]['opportunities'])
+                     for msg in extraction_queue if msg['id'] in extraction_cache}
+        extraction_queue = [msg for msg in extraction_queue if msg['id'] not in extracted]
+        logging.info("  Extraction cache: %s hits, %s misses.", len(extracted), len(extraction_queue))
+        # Batches are fetched and parsed concurrently; matching below stays serial so only the
+        # main thread ever touches the opportunity list and indexes
+        batches = [extraction_queue[start:start + GEMINI_BATCH_SIZE]
+                   for start in range(0, len(extraction_queue), GEMINI_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=EXTRACTION_WORKERS) as executor:
+            for batch, emails, results in executor.map(lambda batch: extract_opportunities_batch(headers, batch), batches):
+                for msg, email, opportunities in zip(batch, emails, results):
+                    extracted[msg['id']] = (email['body'], opportunities)
+                    # Failed parses (None) are left out so the next run tries them again
+                    if opportunities is not None:
+                        # Rows only ever use the first 500 characters of the body
+                        extraction_cache[msg['id']] = {"saved": current_run_timestamp, "body": email['body'][:500], "opportunities": opportunities}
+                save_extraction_cache(extraction_cache)
+        logging.info("  Ran opportunity extraction on %s of %s new emails.", len(extracted), len(new_messages))
+
         new_opportunity_rows = []
         interaction_rows = []
+        newly_processed = []
+        failed_keys = set()  # Content whose extraction failed this run, so its duplicates wait for the retry too
 
         for msg in new_messages:
             msg_id = msg.get('id')
@@ -640,169 +1107,223 @@ def main():
             received_dt = msg.get("receivedDateTime")
             conv_id = msg.get("conversationId")
 
-            logging.info(f"\n  Processing email: '{subject}' from {sender_name}")
+            logging.info("\n  Processing email: '%s' from %s", subject, sender_name)
 
-            body_html = msg.get("body", {}).get("content", "")
-            body_text = html_converter.handle(body_html)
-            
-            # Parse for opportunities
-            opportunities = parse_email_for_opportunities(subject, body_text, sender_email)
+            # Looked up once per email, before this email adds anything to the index, so
+            # several opportunities in one new thread are not folded into the first of them
+            thread_match_id = find_thread_match(thread_index, conv_id, sender_email, subject_keys[msg_id])
+            first_interaction = len(interaction_rows)
+
+            content_key = content_keys[msg_id]
+            content_match_id = None if thread_match_id else content_hashes.get(content_key, {}).get("opp_id")
+
+            if msg_id in extracted:
+                body_text, opportunities = extracted[msg_id]
+            elif content_key in failed_keys:
+                logging.warning("  Duplicate of an email whose extraction failed, will retry next run.")
+                continue
+            else:
+                if not content_match_id and msg_id not in duplicate_ids:
+                    logging.info("  No commercial keywords in preview, skipping body fetch and Gemini extraction.")
+                body_text, opportunities = msg.get("bodyPreview", ""), []
+
+            if opportunities is None and not content_match_id:
+                # Extraction failed; leaving the email unprocessed lets the next run try it again
+                logging.warning("  Opportunity extraction failed for '%s', will retry next run.", subject)
+                if content_key:
+                    failed_keys.add(content_key)
+                continue
             
-            if opportunities:
-                logging.info(f"  Found {len(opportunities)} opportunities in '{subject}'.")
-                for opp in opportunities:
-                    # Enhanced opportunity object for matching
-                    enhanced_opp = {
-                        **opp,
-                        'contact_email': opp.get('contact_email') or sender_email,
-                        'sender_name': sender_name,
-                        'email_subject': subject
-                    }
+            if content_match_id:
+                logging.info("  DUPLICATE CONTENT: Email assigned to Opportunity ID '%s'", content_match_id)
+                interaction_rows.append([
+                    content_match_id, received_dt, "Follow-up", "Email", sender_name,
+                    body_text[:500], "Review", ""
+                ])
+            elif opportunities:
+                logging.info("  Found %s opportunities in '%s'.", len(opportunities), subject)
+                # Enhanced opportunity objects for matching
+                enhanced_opps = [{
+                    **opp,
+                    'contact_email': opp.get('contact_email') or sender_email,
+                    'sender_name': sender_name,
+                    'email_subject': subject
+                } for opp in opportunities]
+                for opp, enhanced_opp in zip(opportunities, enhanced_opps):
+                    opp_summary = opp.get("summary", "N/A")
+                    summary_excerpt = opp_summary[:500]
+                    action_item = opp.get("action_item", "N/A")
                     
-                    # 🏢 STEP 1: Try simple company match first (fastest)
-                    company_match_id = simple_company_match(enhanced_opp, existing_opportunities_list)
+                    # 🏢 STEP 1: Use the thread's opportunity, else a company or email-domain match (fastest)
+                    company_match_id = thread_match_id or match_deterministic(enhanced_opp, existing_opportunities_list, company_index, opportunity_vectors)
                     
                     if company_match_id:
-                        logging.info(f"  COMPANY MATCH: Assigned to existing Opportunity ID '{company_match_id}'")
+                        logging.info("  COMPANY MATCH: Assigned to existing Opportunity ID '%s'", company_match_id)
                         interaction_rows.append([
                             company_match_id, received_dt, "Follow-up", "Email", sender_name, 
-                            opp.get("summary", "N/A")[:500], opp.get("action_item", "N/A"), ""
+                            summary_excerpt, action_item, ""
                         ])
                     else:
                         #  STEP 2: Use vector matching as fallback
-                        logging.info(f"DEBUG: Current matching list has {len(existing_opportunities_list)} opportunities")
+                        logging.debug("Current matching list has %s opportunities", len(existing_opportunities_list))
                         
-                        opp_id, relevant_emails = find_related_opportunity_with_vectors(
+                        opp_id = find_related_opportunity_with_vectors(
                             enhanced_opp, 
                             existing_opportunities_list,
-                            historical_emails
+                            opportunity_vectors
                         )
                         
                         if opp_id:
-                            logging.info(f"VECTOR MATCH: Assigned to existing Opportunity ID '{opp_id}'")
+                            logging.info("VECTOR MATCH: Assigned to existing Opportunity ID '%s'", opp_id)
                             interaction_rows.append([
                                 opp_id, received_dt, "Follow-up", "Email", sender_name, 
-                                opp.get("summary", "N/A")[:500], opp.get("action_item", "N/A"), ""
+                                summary_excerpt, action_item, ""
                             ])
                         else:
                             #  STEP 3: Create new opportunity
                             opp_id = str(uuid.uuid4())
-                            logging.info(f"NEW OPPORTUNITY: Creating Opportunity ID '{opp_id}'.")
+                            logging.info("NEW OPPORTUNITY: Creating Opportunity ID '%s'.", opp_id)
                             
-                            # Find the earliest mention of this opportunity
-                            earliest_mention_date = find_earliest_mention(enhanced_opp, relevant_emails)
+                            # Backdate to the start of its thread when the history has it
+                            earliest_mention_date = find_thread_start(conv_id, historical_index)
                             first_mention_date = earliest_mention_date if earliest_mention_date else received_dt
                             
-                            logging.info(f"First mention date for opportunity: {first_mention_date[:10]}")
+                            logging.info("First mention date for opportunity: %s", first_mention_date[:10])
                             
                             contact_email = enhanced_opp.get("contact_email", "").strip()
                             new_opportunity_rows.append([
                                 opp_id, opp.get("contact_name", sender_name), 
                                 opp.get("contact_company", "NA"), contact_email,
                                 "", opp.get("title", subject), "New Lead", first_mention_date, conv_id, 
-                                opp.get("summary", "N/A")
+                                opp_summary
                             ])
                             interaction_rows.append([
                                 opp_id, received_dt, "New Lead", "Email", sender_name, 
-                                opp.get("summary", "N/A")[:500], opp.get("action_item", "N/A"), ""
+                                summary_excerpt, action_item, ""
                             ])
                             
                             # Add to existing opportunities list IMMEDIATELY
                             new_opp_for_matching = {
                                 "id": opp_id, 
-                                "summary": opp.get("summary", "N/A"), 
+                                "summary": opp_summary, 
                                 "title": opp.get("title", subject), 
                                 "company": opp.get("contact_company", "NA")
                             }
                             existing_opportunities_list.append(new_opp_for_matching)
-                            logging.info(f" Added new opportunity to matching list: '{new_opp_for_matching['title']}'")
+                            logging.info(" Added new opportunity to matching list: '%s'", new_opp_for_matching['title'])
             else:
                 # Check if it's a follow-up to existing opportunity
                 logging.info(" No new opportunities found. Checking for follow-ups...")
+                body_excerpt = body_text[:500]
                 temp_opp = {
                     "title": subject, 
-                    "summary": body_text[:500], 
+                    "summary": body_excerpt, 
                     "contact_company": "NA",
                     "contact_email": sender_email,
                     "sender_name": sender_name
                 }
                 
-                #  STEP 1: Try simple company match first
-                company_match_id = simple_company_match(temp_opp, existing_opportunities_list)
+                #  STEP 1: Use the thread's opportunity, else a company or email-domain match
+                company_match_id = thread_match_id or match_deterministic(temp_opp, existing_opportunities_list, company_index, opportunity_vectors)
                 
                 if company_match_id:
-                    logging.info(f" COMPANY MATCH: General email assigned to Opportunity ID '{company_match_id}'")
+                    logging.info(" COMPANY MATCH: General email assigned to Opportunity ID '%s'", company_match_id)
                     interaction_rows.append([
                         company_match_id, received_dt, "General Communication", "Email", sender_name, 
-                        body_text[:500], "Review", ""
+                        body_excerpt, "Review", ""
                     ])
                 else:
                     # 🔍 STEP 2: Use vector matching as fallback
-                    logging.info(f"DEBUG: Current matching list has {len(existing_opportunities_list)} opportunities")
+                    logging.debug("Current matching list has %s opportunities", len(existing_opportunities_list))
                     
-                    opp_id, relevant_emails = find_related_opportunity_with_vectors(
+                    opp_id = find_related_opportunity_with_vectors(
                         temp_opp, 
                         existing_opportunities_list,
-                        historical_emails
+                        opportunity_vectors
                     )
                     
                     if opp_id:
-                        logging.info(f"VECTOR MATCH: General email assigned to Opportunity ID '{opp_id}'")
+                        logging.info("VECTOR MATCH: General email assigned to Opportunity ID '%s'", opp_id)
                         interaction_rows.append([
                             opp_id, received_dt, "General Communication", "Email", sender_name, 
-                            body_text[:500], "Review", ""
+                            body_excerpt, "Review", ""
                         ])
                     else:
                         # 🆕 STEP 3: Create new opportunity for general email
                         opp_id = str(uuid.uuid4())
-                        logging.info(f"NEW OPPORTUNITY: Creating Opportunity ID '{opp_id}' for general email.")
+                        logging.info("NEW OPPORTUNITY: Creating Opportunity ID '%s' for general email.", opp_id)
                         
-                        # Find the earliest mention of this general communication
-                        earliest_mention_date = find_earliest_mention(temp_opp, relevant_emails)
+                        # Backdate to the start of its thread when the history has it
+                        earliest_mention_date = find_thread_start(conv_id, historical_index)
                         first_mention_date = earliest_mention_date if earliest_mention_date else received_dt
                         
-                        logging.info(f"First mention date for general opportunity: {first_mention_date[:10]}")
+                        logging.info("First mention date for general opportunity: %s", first_mention_date[:10])
                         
                         # Create new opportunity row for general email
                         new_opportunity_rows.append([
                             opp_id, sender_name, "NA", sender_email,
                             "", subject, "General Communication", first_mention_date, conv_id, 
-                            body_text[:500]
+                            body_excerpt
                         ])
                         interaction_rows.append([
                             opp_id, received_dt, "General Communication", "Email", sender_name, 
-                            body_text[:500], "Review", ""
+                            body_excerpt, "Review", ""
                         ])
                         
                         # ✅ Add to existing opportunities list IMMEDIATELY
                         new_opp_for_matching = {
                             "id": opp_id, 
-                            "summary": body_text[:500], 
+                            "summary": body_excerpt, 
                             "title": subject, 
                             "company": "NA"
                         }
                         existing_opportunities_list.append(new_opp_for_matching)
-                        logging.info(f"Added new opportunity to matching list: '{new_opp_for_matching['title']}'")
+                        logging.info("Added new opportunity to matching list: '%s'", new_opp_for_matching['title'])
+
+            if len(interaction_rows) > first_interaction:
+                remember_thread(thread_index, interaction_rows[first_interaction][0], conv_id, sender_email, subject_keys[msg_id])
+                if conv_id:
+                    conversation_map.setdefault(conv_id, interaction_rows[first_interaction][0])
+                if content_key:
+                    content_hashes.setdefault(content_key, {"opp_id": interaction_rows[first_interaction][0], "saved": current_run_timestamp})
 
             # Mark email as processed
             processed_emails.add(msg_id)
+            newly_processed.append((msg_id, received_dt))
         # Save to Excel
         if new_opportunity_rows or interaction_rows:
-            append_rows_to_excel(new_opportunity_rows, "OpportunitiesTable", SHEET_OPPORTUNITIES, excel_file_id, headers)
-            append_rows_to_excel(interaction_rows, "InteractionsTable", SHEET_INTERACTIONS, excel_file_id, headers)
+            if not append_rows_to_excel([
+                (new_opportunity_rows, "OpportunitiesTable", SHEET_OPPORTUNITIES),
+                (interaction_rows, "InteractionsTable", SHEET_INTERACTIONS)
+            ], excel_file_id, workbook_headers):
+                # Nothing is recorded as processed; RECENT_HOURS_BACK spans two daily runs, so the
+                # next run lists these emails again and retries them
+                logging.error(" Excel insert failed; leaving processed emails, caches and timestamp unchanged for the next run to retry.")
+                return
         
         # Save processed emails and timestamp
-        save_processed_emails(processed_emails)
+        # Without the workbook's opportunity IDs these maps couldn't be checked, so the saved copies are kept as they are
+        if opportunities_loaded:
+            save_content_hashes(content_hashes)
+            save_conversation_map(conversation_map)
+        save_processed_emails(newly_processed)
         write_last_run_timestamp(current_run_timestamp)
         
-        logging.info(f"\n--- Cycle Complete ---")
-        logging.info(f" Processed {len(new_messages)} emails")
-        logging.info(f" Created {len(new_opportunity_rows)} new opportunities")
-        logging.info(f" Logged {len(interaction_rows)} interactions")
+        logging.info("\n--- Cycle Complete ---")
+        logging.info(" Processed %s of %s new emails", len(newly_processed), len(new_messages))
+        logging.info(" Created %s new opportunities", len(new_opportunity_rows))
+        logging.info(" Logged %s interactions", len(interaction_rows))
 
     except Exception as e:
         logging.error(f" A critical error occurred in the main process: {e}", exc_info=True)
         raise
+    finally:
+        if excel_file_id:
+            close_workbook_session(excel_file_id, workbook_headers)
 
 if __name__ == "__main__":
+    # Set EMAILBOT_DEBUG=1 for the matching debug logs and the EduTech diagnostic before the normal cycle
+    if os.getenv("EMAILBOT_DEBUG") == "1":
+        logging.getLogger().setLevel(logging.DEBUG)
+        debug_missing_opportunity()
     main()